@@ -1,6 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from numba import njit
 
 
 # --- Parameters ---
@@ -15,191 +20,282 @@ TAU                    = 0.6
 PHI                    = 0.3
 WINNING_COALITION_SIZE = 25
 RATIO_OF_VOTERS        = 0.5
+SEED                   = 1234
+MUTATE_IDEOLOGY        = True
+N_REPLICATES           = 1     # > 1 also runs that many replicates in parallel
+
+# smallest unsigned int with one inclusion bit per candidate
+INC_MASK_DTYPE = np.min_scalar_type((1 << N_CANDIDATES) - 1)
+
+# --- Voting Kernel ---
+# float32 state, int8 ballots (N_CANDIDATES must stay below 128),
+# inclusion packed as bit `cid` of a per-voter mask. Payoffs and the candidate
+# loop bound come from the module constants, which Numba freezes at compile
+# time, so the candidate loop is fully unrolled. Every array length is checked
+# against the frozen N_VOTERS/N_CANDIDATES, since rebinding a constant later
+# does not recompile the kernel.
+@njit('void(f4[::1], f4[::1], f4[::1], f4[::1], '
+      f'i1[::1], {INC_MASK_DTYPE.name}[::1], f4[:, ::1], i4[::1])',
+      cache=True, fastmath=True)
+def _run_gen(voter_ideo, voter_thresh, cand_ideo, cand_alpha,
+             ballots, inc_mask, utils, counts):
+    coal_prob   = np.float32(WINNING_COALITION_SIZE / N_VOTERS)
+    pay_public  = np.float32(RESOURCE_POOL / N_VOTERS)
+    pay_private = np.float32(RESOURCE_POOL / WINNING_COALITION_SIZE)
 
-np.random.seed(1234)
-
-# --- Voter Definition ---
-class Voter:
-    def __init__(self, ideology, risk_type='safe'):
-        self.ideology  = ideology
-        self.risk_type = risk_type
-        self.included  = [False] * N_CANDIDATES
-
-    def utility(self, cand_ideo, cand_alpha, cid):
-        pay_ideo    = (self.ideology - cand_ideo)**2
-        pay_public  = cand_alpha * (RESOURCE_POOL / N_VOTERS)
-        pay_private = ((1 - cand_alpha) * (RESOURCE_POOL / WINNING_COALITION_SIZE)
-                       if self.included[cid] else 0)
-        return pay_ideo + pay_public + pay_private
-
-    def inclusion(self, cid, coal_prob, cand_ideo):
-        dist   = abs(self.ideology - cand_ideo)
-        thresh = TAU if self.risk_type == 'risk' else PHI
-        self.included[cid] = (dist <= THETA and coal_prob >= thresh)
-        return self.included[cid]
-
-# --- Candidate Definition ---
-class Candidate:
-    def __init__(self, ideology, alpha):
-        self.ideology = ideology
-        self.alpha    = alpha
-
-    def mutate(self, mutate_ideology=True):
-        new_alpha = np.clip(
-            self.alpha + np.random.normal(0, PUBLIC_GOODS_MUT_STD), 0, 1
-        )
-        new_ideo  = (
-            self.ideology + np.random.normal(0, POLICY_MUT_STD)
-            if mutate_ideology else self.ideology
-        )
-        new_ideo  = np.clip(new_ideo, -100, 100)
-        return Candidate(new_ideo, new_alpha)
+    n_voters = voter_ideo.shape[0]
+    if (n_voters != N_VOTERS
+            or voter_thresh.shape[0] != N_VOTERS
+            or ballots.shape[0] != N_VOTERS
+            or inc_mask.shape[0] != N_VOTERS
+            or utils.shape[0] != N_VOTERS):
+        raise ValueError('_run_gen: voter arrays do not match the '
+                         'compiled N_VOTERS')
+    if (cand_ideo.shape[0] != N_CANDIDATES
+            or cand_alpha.shape[0] != N_CANDIDATES
+            or utils.shape[1] != N_CANDIDATES
+            or counts.shape[0] != N_CANDIDATES):
+        raise ValueError('_run_gen: candidate arrays do not match the '
+                         'compiled N_CANDIDATES')
+
+    counts[:] = 0
+    for v in range(n_voters):
+        eligible  = coal_prob >= voter_thresh[v]
+        best_cid  = 0
+        best_util = np.float32(0)
+        mask      = 0
+        for c in range(N_CANDIDATES):
+            d   = voter_ideo[v] - cand_ideo[c]
+            inc = eligible and abs(d) <= THETA
+            u   = d * d + cand_alpha[c] * pay_public
+            if inc:
+                u    += (1 - cand_alpha[c]) * pay_private
+                mask |= 1 << c
+            utils[v, c] = u
+            # first-max wins, matching np.argmax tie-breaking
+            if c == 0 or u > best_util:
+                best_cid  = c
+                best_util = u
+        ballots[v]  = best_cid
+        inc_mask[v] = mask
+        counts[best_cid] += 1
 
 # --- Detailed Simulator ---
 class DetailedElectionSim:
-    def __init__(self):
-        # initialize voters
+    def __init__(self, seed=SEED):
+        # seed: int, SeedSequence (e.g. a spawned child) or Generator
+        self.rng = np.random.default_rng(seed)
+        # initialize voters (structure-of-arrays, one entry per voter)
         n_safe = int(N_VOTERS * RATIO_OF_VOTERS)
-        types  = ['safe'] * n_safe + ['risk'] * (N_VOTERS - n_safe)
-        self.voters = [
-            Voter(np.random.uniform(0, 100), types[i]) for i in range(N_VOTERS)
-        ]
-        # initialize candidates
-        self.candidates = [
-            Candidate(np.random.uniform(0, 100), np.random.uniform(0, 1))
-            for _ in range(N_CANDIDATES)
-        ]
-
-    def run_generation_detailed(self):
-        ballots   = []
-        vote_info = []
-
-        # collect utilities & inclusion per voter
-        for vid, v in enumerate(self.voters):
-            v.included = [False] * N_CANDIDATES  # reset
-            utils = []
-            for cid, c in enumerate(self.candidates):
-                coal_prob = WINNING_COALITION_SIZE / N_VOTERS
-                _ = v.inclusion(cid, coal_prob, c.ideology)
-                utils.append(v.utility(c.ideology, c.alpha, cid))
-            choice = int(np.argmax(utils))
-            ballots.append(choice)
-            vote_info.append({
-                'voter_id': vid,
-                'risk_type': v.risk_type,
-                'utilities': utils,
-                'included': v.included.copy(),
-                'ballot': choice
-            })
+        types  = np.array(['safe'] * n_safe + ['risk'] * (N_VOTERS - n_safe))
+        self.voter_ideo = self.rng.uniform(0, 100, N_VOTERS).astype(np.float32)
+        self.voter_type = types
+        self.voter_risk = types == 'risk'
+        # inclusion threshold resolved once from each voter's risk profile
+        self.voter_thresh = np.where(self.voter_risk, TAU, PHI).astype(np.float32)
+        # initialize candidates (ideology, alpha) drawn pairwise per candidate
+        cand_init       = self.rng.uniform([0, 0], [100, 1], (N_CANDIDATES, 2))
+        self.cand_ideo  = cand_init[:, 0].astype(np.float32)
+        self.cand_alpha = cand_init[:, 1].astype(np.float32)
+        # mutation noise for every (generation, candidate), drawn up front
+        self._alpha_noise = self.rng.normal(
+            0, PUBLIC_GOODS_MUT_STD, (MAX_GENERATIONS, N_CANDIDATES)
+        ).astype(np.float32)
+        self._ideo_noise  = self.rng.normal(
+            0, POLICY_MUT_STD, (MAX_GENERATIONS, N_CANDIDATES)
+        ).astype(np.float32)
+        # default kernel outputs when the caller supplies none
+        self._ballots  = np.empty(N_VOTERS, np.int8)
+        self._inc_mask = np.empty(N_VOTERS, INC_MASK_DTYPE)
+        self._utils    = np.empty((N_VOTERS, N_CANDIDATES), np.float32)
+        self._counts   = np.empty(N_CANDIDATES, np.int32)
+        # _losers[w] selects every candidate except winner w
+        self._losers   = ~np.eye(N_CANDIDATES, dtype=np.bool_)
 
-        # tally votes and mutate losers
-        counts     = np.bincount(ballots, minlength=N_CANDIDATES).tolist()
-        winner_idx = int(np.argmax(counts))
-        for cid in range(N_CANDIDATES):
-            if cid != winner_idx:
-                self.candidates[cid] = self.candidates[winner_idx].mutate()
+    def run_generation_detailed(self, gen, ballots=None, inc_mask=None,
+                                utils=None, counts=None):
+        # utilities, inclusion, ballots & vote tally in one compiled pass,
+        # written into the given arrays (default buffers are overwritten by
+        # the next generation)
+        # (_run_gen raises ValueError if any buffer has the wrong length)
+        ballots  = self._ballots  if ballots  is None else ballots
+        inc_mask = self._inc_mask if inc_mask is None else inc_mask
+        utils    = self._utils    if utils    is None else utils
+        counts   = self._counts   if counts   is None else counts
+        _run_gen(self.voter_ideo, self.voter_thresh, self.cand_ideo,
+                 self.cand_alpha, ballots, inc_mask, utils, counts)
 
-        return vote_info, counts, winner_idx
+        # pick the winner and mutate losers
+        winner_idx = int(counts.argmax())  # first max wins ties
+        losers     = self._losers[winner_idx]
+        new_alpha  = self.cand_alpha[winner_idx] + self._alpha_noise[gen, losers]
+        new_ideo   = self.cand_ideo[winner_idx]
+        if MUTATE_IDEOLOGY:
+            new_ideo = new_ideo + self._ideo_noise[gen, losers]
+        self.cand_alpha[losers] = np.clip(new_alpha, 0, 1)
+        self.cand_ideo[losers]  = np.clip(new_ideo, -100, 100)
 
-    def run_simulation_detailed(self):
-        vote_records     = []
-        election_summary = []
-        candidate_records = []
+        return ballots, inc_mask, utils, counts, winner_idx
+
+    def run_simulation_detailed(self, record_votes=True,
+                                record_candidates=True, record_summary=True):
+        # frames that are not recorded come back as None; per-voter buffers
+        # are only allocated when the vote frame is wanted
+        if record_votes:
+            n_rows     = MAX_GENERATIONS * N_VOTERS
+            ballot_col = np.empty(n_rows, np.int8)
+            inc_col    = np.empty(n_rows, INC_MASK_DTYPE)
+            util_col   = np.empty((n_rows, N_CANDIDATES), np.float32)
+        ideo_hist   = np.empty((MAX_GENERATIONS, N_CANDIDATES), np.float32)
+        alpha_hist  = np.empty((MAX_GENERATIONS, N_CANDIDATES), np.float32)
+        counts_hist = np.empty((MAX_GENERATIONS, N_CANDIDATES), np.int32)
+        winner_hist = np.empty(MAX_GENERATIONS, np.int8)
 
         for gen in range(MAX_GENERATIONS):
-            vote_info, counts, winner = self.run_generation_detailed()
-
-            # record candidate state for plotting
-            for cid, c in enumerate(self.candidates):
-                candidate_records.append({
-                    'generation': gen,
-                    'candidate_id': cid,
-                    'ideology': c.ideology,
-                    'alpha': c.alpha,
-                    'is_winner': (cid == winner)
-                })
-
-            # record summary
-            election_summary.append({
-                'generation': gen,
-                'vote_counts': counts,
-                'winner_idx': winner
-            })
+            # the kernel writes this generation's rows & tally in place
+            if record_votes:
+                rows = slice(gen * N_VOTERS, (gen + 1) * N_VOTERS)
+                outs = (ballot_col[rows], inc_col[rows], util_col[rows])
+            else:
+                outs = (None, None, None)
+            _, _, _, _, winner = self.run_generation_detailed(
+                gen, *outs, counts_hist[gen]
+            )
+
+            # candidate state for plotting
+            ideo_hist[gen]   = self.cand_ideo
+            alpha_hist[gen]  = self.cand_alpha
+            winner_hist[gen] = winner
+
+        # build DataFrames column-wise
+        df_votes = df_summary = df_candidates = None
+        generations = np.arange(MAX_GENERATIONS)
+        if record_votes:
+            vote_cols = {
+                'generation': np.repeat(generations, N_VOTERS),
+                'voter_id': np.tile(np.arange(N_VOTERS), MAX_GENERATIONS),
+                'risk_type': np.tile(self.voter_type, MAX_GENERATIONS),
+                'voted_for': ballot_col,
+                'voter_ideology': np.tile(self.voter_ideo, MAX_GENERATIONS)
+            }
+            for cid in range(N_CANDIDATES):
+                vote_cols[f'count_c{cid}'] = np.repeat(counts_hist[:, cid],
+                                                       N_VOTERS)
+            vote_cols['winner_idx'] = np.repeat(winner_hist, N_VOTERS)
+            for cid in range(N_CANDIDATES):
+                vote_cols[f'cand{cid}_ideology'] = np.repeat(ideo_hist[:, cid],
+                                                             N_VOTERS)
+                vote_cols[f'cand{cid}_alpha']    = np.repeat(alpha_hist[:, cid],
+                                                             N_VOTERS)
+                vote_cols[f'cand{cid}_included'] = (inc_col >> cid) & 1 == 1
+                vote_cols[f'cand{cid}_utility']  = util_col[:, cid]
+            df_votes = pd.DataFrame(vote_cols)
+
+        if record_summary:
+            summary_cols = {'generation': generations}
+            for cid in range(N_CANDIDATES):
+                summary_cols[f'count_c{cid}'] = counts_hist[:, cid]
+            summary_cols['winner_idx'] = winner_hist
+            df_summary = pd.DataFrame(summary_cols)
 
-            # record per-voter data
-            for info in vote_info:
-                rec = {
-                    'generation': gen,
-                    'voter_id': info['voter_id'],
-                    'risk_type': info['risk_type'],
-                    'voted_for': info['ballot'],
-                    'voter_ideology': self.voters[info['voter_id']].ideology,
-                    'vote_counts': counts,
-                    'winner_idx': winner
-                }
-                for cid, c in enumerate(self.candidates):
-                    rec[f'cand{cid}_ideology'] = c.ideology
-                    rec[f'cand{cid}_alpha']    = c.alpha
-                    rec[f'cand{cid}_included'] = info['included'][cid]
-                    rec[f'cand{cid}_utility']  = info['utilities'][cid]
-                vote_records.append(rec)
-
-        # build DataFrames
-        df_votes      = pd.DataFrame(vote_records)
-        df_summary    = pd.DataFrame(election_summary)
-        df_candidates = pd.DataFrame(candidate_records)
+        if record_candidates:
+            cand_winner   = np.repeat(winner_hist, N_CANDIDATES)
+            cand_ids      = np.tile(np.arange(N_CANDIDATES), MAX_GENERATIONS)
+            df_candidates = pd.DataFrame({
+                'generation': np.repeat(generations, N_CANDIDATES),
+                'candidate_id': cand_ids,
+                'ideology': ideo_hist.ravel(),
+                'alpha': alpha_hist.ravel(),
+                'is_winner': cand_ids == cand_winner
+            })
 
         return df_votes, df_summary, df_candidates
 
+# --- Replicates ---
+def run_replicate(replicate, seed_seq):
+    sim = DetailedElectionSim(seed_seq)
+    _, df_summary, _ = sim.run_simulation_detailed(record_votes=False,
+                                                   record_candidates=False)
+    df_summary.insert(0, 'replicate', replicate)
+    return df_summary
+
+def run_replicates(n_replicates, seed=SEED, max_workers=None):
+    # independent child seed sequences of one root seed, one per replicate
+    streams = np.random.SeedSequence(seed).spawn(n_replicates)
+    with ProcessPoolExecutor(max_workers) as ex:
+        return pd.concat(ex.map(run_replicate, range(n_replicates), streams),
+                         ignore_index=True)
+
+# --- CSV Export ---
+def write_csv(df, path):
+    pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+
 # --- Run & Export ---
-sim = DetailedElectionSim()
-df_votes, df_summary, df_candidates = sim.run_simulation_detailed()
-
-# Preview data
-# tools.display_dataframe_to_user("Vote Data Sample", df_votes.head())
-# tools.display_dataframe_to_user("Election Summary Sample", df_summary.head())
-# tools.display_dataframe_to_user("Candidate Trajectory Sample", df_candidates.head())
-
-# Export CSVs
-df_votes.to_csv("vote_data.csv", index=False)
-df_summary.to_csv("election_summary.csv", index=False)
-df_candidates.to_csv("candidate_trajectory.csv", index=False)
-print("Exported vote_data.csv, election_summary.csv, candidate_trajectory.csv")
-
-# --- Plots ---
-losers  = df_candidates[df_candidates['is_winner'] == False]
-winners = df_candidates[df_candidates['is_winner'] == True]
-colors = ['blue', 'yellow', 'green', 'purple']
-
-# Ideology plot
-plt.figure(figsize=(10, 6))
-plt.scatter(losers['generation'], losers['ideology'],
-            color='gray', alpha=0.4, s=10, label='Losers')
-for idx, col in enumerate(colors):
-    sub = winners[winners['candidate_id'] == idx]
-    plt.scatter(sub['generation'], sub['ideology'],
-                color=col, alpha=0.9, s=20, label=f'Winner Cand {idx+1}')
-plt.xlabel('Generation')
-plt.ylabel('Ideology')
-plt.title('Candidate Ideologies Across Generations')
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.show()
-
-# Alpha plot
-plt.figure(figsize=(10, 6))
-plt.scatter(losers['generation'], losers['alpha'],
-            color='gray', alpha=0.4, s=10, label='Losers')
-for idx, col in enumerate(colors):
-    sub = winners[winners['candidate_id'] == idx]
-    plt.scatter(sub['generation'], sub['alpha'],
-                color=col, alpha=0.9, s=20, label=f'Winner Cand {idx+1}')
-plt.xlabel('Generation')
-plt.ylabel('Alpha (Public Goods Allocation)')
-plt.title('Candidate Alpha Across Generations')
-plt.legend()
-plt.grid(True)
-plt.tight_layout()
-plt.show()
+if __name__ == '__main__':
+    sim = DetailedElectionSim()
+    df_votes, df_summary, df_candidates = sim.run_simulation_detailed()
+
+    # Preview data
+    # tools.display_dataframe_to_user("Vote Data Sample", df_votes.head())
+    # tools.display_dataframe_to_user("Election Summary Sample", df_summary.head())
+    # tools.display_dataframe_to_user("Candidate Trajectory Sample", df_candidates.head())
+
+    # Export CSVs
+    write_csv(df_votes, "vote_data.csv")
+    write_csv(df_summary, "election_summary.csv")
+    write_csv(df_candidates, "candidate_trajectory.csv")
+    print("Exported vote_data.csv, election_summary.csv, candidate_trajectory.csv")
+
+    if N_REPLICATES > 1:
+        df_replicates = run_replicates(N_REPLICATES)
+        write_csv(df_replicates, "replicate_summary.csv")
+        print("Exported replicate_summary.csv")
+
+    # --- Plots ---
+    # losers are binned (hexbin) since their count grows with generations;
+    # vmin=0 keeps count-1 cells grey rather than the colormap's white end
+    # split in one grouping pass: key -1 = losers, key i = candidate i's wins
+    role    = df_candidates['candidate_id'].where(df_candidates['is_winner'], -1)
+    groups  = dict(tuple(df_candidates.groupby(role, sort=False)))
+    no_rows = df_candidates.iloc[:0]
+    losers  = groups.get(-1, no_rows)
+    colors = ['blue', 'yellow', 'green', 'purple']
+
+    # Ideology plot
+    plt.figure(figsize=(10, 6))
+    hb = plt.hexbin(losers['generation'], losers['ideology'], gridsize=100,
+                    cmap='Greys', mincnt=1, vmin=0)
+    # legend entry in the colour of a single-loser cell
+    plt.scatter([], [], color=hb.cmap(hb.norm(1)), marker='h', s=20,
+                label='Losers')
+    for idx, col in enumerate(colors):
+        sub = groups.get(idx, no_rows)
+        plt.scatter(sub['generation'], sub['ideology'],
+                    color=col, alpha=0.9, s=20, label=f'Winner Cand {idx+1}')
+    plt.xlabel('Generation')
+    plt.ylabel('Ideology')
+    plt.title('Candidate Ideologies Across Generations')
+    plt.legend()
+    plt.grid(True)
+    plt.tight_layout()
+    plt.show()
+
+    # Alpha plot
+    plt.figure(figsize=(10, 6))
+    hb = plt.hexbin(losers['generation'], losers['alpha'], gridsize=100,
+                    cmap='Greys', mincnt=1, vmin=0)
+    # legend entry in the colour of a single-loser cell
+    plt.scatter([], [], color=hb.cmap(hb.norm(1)), marker='h', s=20,
+                label='Losers')
+    for idx, col in enumerate(colors):
+        sub = groups.get(idx, no_rows)
+        plt.scatter(sub['generation'], sub['alpha'],
+                    color=col, alpha=0.9, s=20, label=f'Winner Cand {idx+1}')
+    plt.xlabel('Generation')
+    plt.ylabel('Alpha (Public Goods Allocation)')
+    plt.title('Candidate Alpha Across Generations')
+    plt.legend()
+    plt.grid(True)
+    plt.tight_layout()
+    plt.show()
 